@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Load tests for the server. `burst` opens a large number of connections at
+once, spread across a few loopback source addresses, and reports how many
+registered and how many were refused by the connection limits. `ping`
+registers a set of clients that each send PINGs one at a time, and
+reports throughput and round-trip latency.
+
+Either test runs against an already running server:
+
+    py3ircd/main.py &
+    ./loadtest.py burst --connections 10000 --sources 4
+
+or with --compare, starts a server for each set of server options given
+and prints the results side by side:
+
+    ./loadtest.py --compare '--backend asyncio' --compare '--backend uvloop' ping
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import shlex
+import subprocess
+import sys
+import time
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'py3ircd', 'main.py')
+
+async def register(i, args, source=None):
+    """
+    Connects and registers a client. Returns (reader, writer, server name),
+    or None if the server refused the connection.
+    """
+    reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(args.host, args.port,
+                local_addr=(source, 0) if source else None),
+            args.timeout)
+    nick = f'load{i}'
+    writer.write(f'NICK {nick}\r\nUSER {nick} {nick} localhost :Load {i}\r\n'.encode())
+    while True:
+        line = await asyncio.wait_for(reader.readline(), args.timeout)
+        if not line or line.startswith(b'ERROR'):
+            writer.close()
+            return None
+        prefix, code = line.split()[:2]
+        if code == b'001':
+            return reader, writer, prefix[1:].decode()
+
+async def burst_client(i, args, source, results, done):
+    try:
+        conn = await register(i, args, source)
+    except (OSError, asyncio.TimeoutError):
+        results['failed'] += 1
+        return
+    if conn is None:
+        results['refused'] += 1
+        return
+    results['registered'] += 1
+    await done.wait()
+    conn[1].close()
+
+async def burst(args):
+    """
+    Opens all connections at once and holds the registered ones open
+    until every connection has finished.
+    """
+    results = {'registered': 0, 'refused': 0, 'failed': 0}
+    # Separate /24s exercise the per-IP limits, a shared one the per-CIDR ones
+    if args.same_cidr:
+        sources = [f'127.0.0.{n + 1}' for n in range(args.sources)]
+    else:
+        sources = [f'127.0.{n}.1' for n in range(args.sources)]
+    done = asyncio.Event()
+
+    start = time.monotonic()
+    tasks = [asyncio.ensure_future(burst_client(i, args, sources[i % len(sources)], results, done))
+            for i in range(args.connections)]
+    while sum(results.values()) < args.connections:
+        await asyncio.sleep(0.1)
+    results['seconds'] = round(time.monotonic() - start, 2)
+
+    done.set()
+    await asyncio.gather(*tasks)
+    return results
+
+async def ping_client(reader, writer, name, args, latencies):
+    line = f'PING :{name}\r\n'.encode()
+    try:
+        for _ in range(args.pings):
+            start = time.perf_counter()
+            writer.write(line)
+            while True:
+                reply = await asyncio.wait_for(reader.readline(), args.timeout)
+                if not reply:
+                    raise ConnectionError('Server closed the connection')
+                if reply.split()[1:2] == [b'PONG']:
+                    break
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+async def ping(args):
+    """
+    Registers the clients one at a time, then has them all send PINGs
+    concurrently.
+    """
+    conns = []
+    for i in range(args.clients):
+        conn = await register(i, args)
+        if conn is None:
+            raise SystemExit('Connection refused, raise the server connection limits')
+        conns.append(conn)
+
+    latencies = []
+    start = time.monotonic()
+    await asyncio.gather(*[ping_client(*c, args, latencies) for c in conns])
+    elapsed = time.monotonic() - start
+
+    latencies.sort()
+    ms = lambda q: round(latencies[int(q * (len(latencies) - 1))] * 1000, 3)
+    return {
+        'msgs/sec': round(len(latencies) / elapsed),
+        'p50 ms': ms(0.5),
+        'p99 ms': ms(0.99),
+        'max ms': ms(1),
+    }
+
+def run_test(args):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(args.test(args))
+    finally:
+        loop.close()
+
+def run_with_server(args, server_args):
+    """
+    Starts a server with the given options, runs the test against it and
+    stops it again. Returns None if the server did not start.
+    """
+    cmd = [sys.executable, SERVER, '--log-level', 'WARNING',
+            '--listen', f'{args.host}:{args.port}']
+    cmd += shlex.split(args.server_defaults) + shlex.split(server_args)
+    proc = subprocess.Popen(cmd, cwd=os.path.dirname(SERVER))
+    try:
+        time.sleep(args.startup)
+        if proc.poll() is not None:
+            print(f'Server failed to start: {server_args}', file=sys.stderr)
+            return None
+        return run_test(args)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+def print_results(rows):
+    columns = list(rows[0][1])
+    width = max(len(label) for label, _ in rows)
+    print(f'{"":<{width}}  ' + '  '.join(f'{c:>12}' for c in columns))
+    for label, results in rows:
+        print(f'{label:<{width}}  ' + '  '.join(f'{results[c]:>12}' for c in columns))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6667)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--compare', metavar='SERVER_ARGS', action='append',
+            help='start a server with these options and compare the results; repeatable')
+    parser.add_argument('--startup', type=float, default=1,
+            help='seconds to wait for a started server to listen')
+    tests = parser.add_subparsers(dest='name', required=True)
+
+    p = tests.add_parser('burst', help='many connections at once from a few addresses')
+    p.add_argument('--connections', type=int, default=10000)
+    p.add_argument('--sources', type=int, default=4,
+            help='number of loopback source addresses to spread connections over')
+    p.add_argument('--same-cidr', action='store_true',
+            help='take the source addresses from one /24 instead of one /24 each')
+    p.set_defaults(test=burst, server_defaults='')
+
+    p = tests.add_parser('ping', help='PING round-trip throughput and latency')
+    p.add_argument('--clients', type=int, default=10)
+    p.add_argument('--pings', type=int, default=1000, help='per client')
+    # All clients connect from one address, so lift the limits
+    p.set_defaults(test=ping, server_defaults='--max-per-ip 0 --max-per-cidr 0 '
+            '--ip-connects-per-sec 0 --cidr-connects-per-sec 0')
+
+    args = parser.parse_args()
+
+    # Each connection needs its own file descriptor
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    if args.compare:
+        rows = [(s, run_with_server(args, s)) for s in args.compare]
+        rows = [(label, results) for label, results in rows if results is not None]
+        if not rows:
+            raise SystemExit(1)
+    else:
+        rows = [(f'{args.host}:{args.port}', run_test(args))]
+    print_results(rows)
+
+
+if __name__ == '__main__':
+    main()
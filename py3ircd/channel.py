@@ -39,6 +39,10 @@ class Channel:
         Join the specified client to this channel.
         """
 
+        # Channels restored from a snapshot may have lost their owner
+        if self.owner is None:
+            self.owner = client
+
         self.clients.add(client)
         client.joined_channels[self.name] = self
         self.chansend_as_user('JOIN', str(self), user=client)
@@ -101,8 +105,9 @@ class Channel:
 
         prefix = f'{client.ident.nick} {self}'
         o = self.owner
-        i = o.ident
-        client.send_as_server(RPL_WHOREPLY, f'{prefix} {i.prefix}{i.nick} {i.hostname} {o.server.name} {client.ident.nick} H :0 {i.realname}')
+        if o is not None:
+            i = o.ident
+            client.send_as_server(RPL_WHOREPLY, f'{prefix} {i.prefix}{i.nick} {i.hostname} {o.server.name} {client.ident.nick} H :0 {i.realname}')
         client.send_as_server(RPL_ENDOFWHO, f'{prefix} :End of /WHO list.')
 
     def send_to_channel(self, sender, msg):
@@ -11,6 +11,8 @@ from util import *
 from codes import *
 from channel import Channel
 from exc import *
+from limits import ConnectionLimiter
+import snapshot
 from user import Ident, IncomingCommand
 
 __name__ = 'py3ircd'
@@ -27,13 +29,15 @@ class Client:
     awaiting_pong_since = None
     joined_channels = {} #: {name: Channel}
 
-    def __init__(self, transport, server):
+    def __init__(self, transport, server, hostname=None):
         self._transport = transport
         self.server = server
-        self.ident = Ident(transport.get_extra_info('peername'))
+        # Unix socket peers have no address
+        peername = transport.get_extra_info('peername') or ('localhost', 0)
+        self.ident = Ident(peername, hostname)
         self.connected_at = datetime.datetime.now()
-        ip, port = self.ident._peername
-        log.info(f'{self} ## New connection from {ip}:{port}')
+        ip, port = peername[:2]
+        self.address = f'{ip}:{port}'
 
     def __str__(self):
         return self.ident.nick or '(unreg)'
@@ -138,15 +142,27 @@ class Server:
     clients = {} #: {transport: Client}
     channels = {} #: {name: Channel}
 
+    # Per-IP and per-CIDR connection limits, see limits.ConnectionClass
+    limiter = ConnectionLimiter()
+
     def __str__(self):
         return self.name
 
-    def new_connection(self, transport):
+    def new_connection(self, transport, state=None):
         """
-        Handles an incoming connection from a new client.
+        Handles an incoming connection from a new client. If `state` is
+        given the connection was handed over from a previous process and
+        the client is restored from it rather than starting unregistered.
         """
         assert transport not in self.clients
-        self.clients[transport] = Client(transport, self)
+        if state is None:
+            client = Client(transport, self)
+            log.info(f'{client} ## New connection from {client.address}')
+        else:
+            client = Client(transport, self, state['hostname'])
+            snapshot.restore_client(client, state)
+            log.info(f'{client} ## Restored connection from {client.address}')
+        self.clients[transport] = client
 
     def data_received(self, transport, line):
         """
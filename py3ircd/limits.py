@@ -0,0 +1,150 @@
+"""
+Connection limiting. Incoming connections are sorted into connection
+classes by address, and each class limits how many connections a single
+IP or CIDR block may hold open and how quickly it may open new ones.
+
+All accounting is kept in dicts keyed by address so checking and updating
+a connection is constant time regardless of how many are open.
+"""
+
+import ipaddress
+import logging
+log = logging.getLogger('ircd')
+import time
+
+THROTTLE_WINDOW = 1 # seconds
+
+class ConnectionClass:
+    """
+    Limits applied to connections from the given networks. Any limit set
+    to None is not enforced.
+    """
+
+    def __init__(self, name, networks=('0.0.0.0/0', '::/0'),
+            max_per_ip=10, max_per_cidr=50, cidr_v4=24, cidr_v6=64,
+            ip_connects_per_sec=5, cidr_connects_per_sec=20):
+        self.name = name
+        self.networks = [ipaddress.ip_network(n) for n in networks]
+        self.max_per_ip = max_per_ip
+        self.max_per_cidr = max_per_cidr
+        self.cidr_prefix = {4: cidr_v4, 6: cidr_v6}
+        self.ip_connects_per_sec = ip_connects_per_sec
+        self.cidr_connects_per_sec = cidr_connects_per_sec
+
+    def __str__(self):
+        return self.name
+
+    def matches(self, addr):
+        return any(addr in n for n in self.networks)
+
+    def cidr_of(self, addr):
+        """
+        Returns the CIDR block the address is accounted against.
+        """
+        prefix = self.cidr_prefix[addr.version]
+        return ipaddress.ip_network(f'{addr}/{prefix}', strict=False)
+
+class ConnectionLimiter:
+    """
+    Tracks open connections and recent connects per IP and CIDR block.
+    Connection classes are checked in order and the first match applies.
+    """
+
+    def __init__(self, classes=None):
+        self.classes = classes or [ConnectionClass('default')]
+        self.ip_counts = {} #: {address: open connections}
+        self.cidr_counts = {} #: {network: open connections}
+        self.ip_throttle = {} #: {address: [expires, connects]}
+        self.cidr_throttle = {} #: {network: [expires, connects]}
+
+    def _lookup(self, ip):
+        """
+        Returns (class, address, network) for the given IP, or None if
+        no class applies.
+        """
+        if ip is None:
+            return None
+        addr = ipaddress.ip_address(ip)
+        if addr.version == 6 and addr.ipv4_mapped:
+            addr = addr.ipv4_mapped
+        for cls in self.classes:
+            if cls.matches(addr):
+                return cls, addr, cls.cidr_of(addr)
+        return None
+
+    def _throttled(self, throttle, key, limit, now):
+        """
+        Counts a connect against `key` and returns True if it is over the
+        limit for the current window.
+        """
+        entry = throttle.get(key)
+        if entry is None or entry[0] <= now:
+            entry = throttle[key] = [now + THROTTLE_WINDOW, 0]
+        entry[1] += 1
+        return limit is not None and entry[1] > limit
+
+    def _count(self, addr, net):
+        self.ip_counts[addr] = self.ip_counts.get(addr, 0) + 1
+        self.cidr_counts[net] = self.cidr_counts.get(net, 0) + 1
+
+    def admit(self, ip, now=None):
+        """
+        Checks a new connection from `ip` against its class. Returns None
+        and counts the connection if allowed, otherwise the reason it was
+        refused. Allowed connections must be passed to `release()` when
+        they close.
+        """
+        match = self._lookup(ip)
+        if match is None:
+            return None
+        cls, addr, net = match
+        now = time.monotonic() if now is None else now
+
+        # Check the network first so a throttled network that connects from
+        # a new address each time adds no per-IP entries
+        if (self._throttled(self.cidr_throttle, net, cls.cidr_connects_per_sec, now)
+                or self._throttled(self.ip_throttle, addr, cls.ip_connects_per_sec, now)):
+            return 'Throttled: reconnecting too fast'
+
+        if cls.max_per_ip is not None and self.ip_counts.get(addr, 0) >= cls.max_per_ip:
+            return 'Too many connections from your host'
+        if cls.max_per_cidr is not None and self.cidr_counts.get(net, 0) >= cls.max_per_cidr:
+            return 'Too many connections from your network'
+
+        self._count(addr, net)
+        return None
+
+    def track(self, ip):
+        """
+        Counts an already established connection (such as one handed over
+        from a previous process) without applying any limits.
+        """
+        match = self._lookup(ip)
+        if match is None:
+            return
+        _, addr, net = match
+        self._count(addr, net)
+
+    def release(self, ip):
+        """
+        Removes a closed connection previously allowed by `admit()`.
+        """
+        match = self._lookup(ip)
+        if match is None:
+            return
+        _, addr, net = match
+        for counts, key in ((self.ip_counts, addr), (self.cidr_counts, net)):
+            n = counts.get(key, 0) - 1
+            if n > 0:
+                counts[key] = n
+            else:
+                counts.pop(key, None)
+
+    def expire(self, now=None):
+        """
+        Drops throttle entries whose window has passed.
+        """
+        now = time.monotonic() if now is None else now
+        for throttle in (self.ip_throttle, self.cidr_throttle):
+            for key in [k for k, (expires, _) in throttle.items() if expires <= now]:
+                del throttle[key]
@@ -1,12 +1,135 @@
 #!/usr/bin/env python3
 
+import argparse
+import configparser
+import importlib.util
 import logging
-logging.basicConfig(level=logging.DEBUG)
 
-from net import run_server
+from limits import ConnectionClass
+import snapshot
+from net import BACKENDS, DEFAULT_LISTEN, SocketOptions, parse_listen, run_server
+
+# Options that can be given in these sections of the config file
+CONFIG_SECTIONS = ('server', 'limits')
+LOG_LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')
+LIMIT_OPTIONS = ('max_per_ip', 'max_per_cidr', 'ip_connects_per_sec', 'cidr_connects_per_sec')
+
+def listen_address(spec):
+    """
+    Argument type for --listen. Checks the address but keeps it as given.
+    """
+    try:
+        parse_listen(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    return spec
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='py3ircd IRC server')
+    parser.add_argument('--config', metavar='FILE',
+            help='read options from this INI file; command line options override it')
+    parser.add_argument('--log-level', type=str.upper, choices=LOG_LEVELS, default='DEBUG')
+
+    net = parser.add_argument_group('network')
+    net.add_argument('--listen', metavar='ADDR', nargs='+', type=listen_address,
+            default=list(DEFAULT_LISTEN),
+            help='host:port, [ipv6]:port or unix:/path to listen on')
+    net.add_argument('--backend', choices=BACKENDS, default='auto',
+            help='event loop to use; auto picks uvloop if installed')
+    net.add_argument('--backlog', type=int, default=100)
+    net.add_argument('--nodelay', action=argparse.BooleanOptionalAction, default=True,
+            help='set TCP_NODELAY on client connections')
+    net.add_argument('--keepalive', action=argparse.BooleanOptionalAction, default=False,
+            help='set SO_KEEPALIVE on client connections')
+    net.add_argument('--sndbuf', type=int, metavar='BYTES')
+    net.add_argument('--rcvbuf', type=int, metavar='BYTES')
+
+    limits = parser.add_argument_group('connection limits', '0 disables a limit')
+    for name in LIMIT_OPTIONS:
+        limits.add_argument('--' + name.replace('_', '-'), type=int, metavar='N')
+
+    restart = parser.add_argument_group('restart')
+    restart.add_argument('--snapshot', metavar='FILE',
+            help='save channel state here on shutdown and reload it on startup')
+    restart.add_argument('--handoff', metavar='PATH',
+            help='Unix socket a new process can connect to in order to take over')
+    restart.add_argument('--takeover', metavar='PATH',
+            help='take over the clients of the server with this handoff socket')
+    return parser
+
+def load_config(parser, path):
+    """
+    Reads an INI config file and sets its values as the parser defaults.
+    Keys are the long option names with underscores, e.g. `log_level`.
+    The values are passed through the parser as if given on the command
+    line, so they are converted and checked the same way.
+    """
+    config = configparser.ConfigParser()
+    if not config.read(path):
+        parser.error(f'cannot read config file {path}')
+
+    for section in config.sections():
+        if section not in CONFIG_SECTIONS:
+            parser.error(f'unknown section [{section}] in {path}')
+
+    known = vars(parser.parse_args([]))
+    keys = []
+    argv = []
+    for section in CONFIG_SECTIONS:
+        if section not in config:
+            continue
+        for key, value in config[section].items():
+            if key not in known or key == 'config':
+                parser.error(f'unknown option {key!r} in {path}')
+            option = '--' + key.replace('_', '-')
+            if key == 'listen':
+                argv += [option] + value.replace(',', ' ').split()
+            elif isinstance(known[key], bool):
+                try:
+                    enabled = config[section].getboolean(key)
+                except ValueError:
+                    parser.error(f'invalid boolean for {key!r} in {path}: {value!r}')
+                argv.append(option if enabled else '--no-' + option[2:])
+            else:
+                argv.append(f'{option}={value}')
+            keys.append(key)
+
+    parsed = vars(parser.parse_args(argv))
+    parser.set_defaults(**{k: parsed[k] for k in keys})
+
+def connection_classes(args):
+    """
+    Returns the connection classes for the limits given, or None to keep
+    the default limits.
+    """
+    limits = {k: getattr(args, k) for k in LIMIT_OPTIONS if getattr(args, k) is not None}
+    if not limits:
+        return None
+    return [ConnectionClass('default', **{k: v or None for k, v in limits.items()})]
 
 def main():
-    run_server()
+    parser = build_parser()
+    args, _ = parser.parse_known_args()
+    if args.config:
+        load_config(parser, args.config)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+
+    if args.backend == 'uvloop' and importlib.util.find_spec('uvloop') is None:
+        parser.error('--backend uvloop: uvloop is not installed')
+
+    if args.snapshot:
+        try:
+            snapshot.check_writable(args.snapshot)
+        except OSError as e:
+            parser.error(f'--snapshot: {e}')
+
+    options = SocketOptions(backlog=args.backlog, nodelay=args.nodelay,
+            keepalive=args.keepalive, sndbuf=args.sndbuf, rcvbuf=args.rcvbuf)
+    run_server(listen=args.listen, backend=args.backend, options=options,
+            connection_classes=connection_classes(args), snapshot_path=args.snapshot,
+            handoff_path=args.handoff, takeover_from=args.takeover)
 
 
 if __name__ == '__main__':
@@ -8,20 +8,92 @@ if required.
 import asyncio
 import logging
 logging.getLogger('asyncio').setLevel(logging.WARNING)
+log = logging.getLogger('ircd')
+import os
+import signal
+import socket
+import stat
+import struct
 
 from irc import Server
+from limits import ConnectionLimiter
+import snapshot
 server = Server()
 
 TIMER_INTERVAL = 30
+HANDOFF_TIMEOUT = 10
+HANDOFF_MAX_FDS = 250 # per message, must stay below the kernel's SCM_MAX_FD
+DEFAULT_LISTEN = ('0.0.0.0:6667',)
+BACKENDS = ('auto', 'asyncio', 'uvloop')
+
+class SocketOptions:
+    """
+    Tunable options for listening and client sockets. Buffer sizes of None
+    leave the kernel defaults alone.
+    """
+
+    def __init__(self, backlog=100, nodelay=True, keepalive=False, sndbuf=None, rcvbuf=None):
+        self.backlog = backlog
+        self.nodelay = nodelay
+        self.keepalive = keepalive
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+
+    def apply_listener(self, sock):
+        """
+        Applies options to a listening socket before it is bound. Buffer
+        sizes are inherited by accepted connections and must be set here
+        for the TCP window scale to take them into account.
+        """
+        if self.sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+
+    def apply_connection(self, sock):
+        """
+        Applies options to an accepted TCP connection.
+        """
+        if sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+            return
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.nodelay))
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, int(self.keepalive))
+
+socket_options = SocketOptions()
 
 class IRCClientProtocol(asyncio.Protocol):
     """
     Client protocol class that delegates to the server instance.
+    `state` is set for connections handed over from a previous process.
     """
 
+    def __init__(self, state=None):
+        self.state = state
+        self.admitted = False
+
     def connection_made(self, transport):
         self.transport = transport
-        server.new_connection(transport)
+        socket_options.apply_connection(transport.get_extra_info('socket'))
+
+        # Unix socket peers have no address and are not limited
+        peername = transport.get_extra_info('peername')
+        ip = peername[0] if peername else None
+
+        # Check limits before any per-client work such as the DNS lookup
+        if self.state is not None:
+            server.limiter.track(ip)
+        else:
+            reason = server.limiter.admit(ip)
+            if reason is not None:
+                log.info(f'Refused connection from {ip} ({reason})')
+                transport.write(f'ERROR :Closing Link: {ip} ({reason})\r\n'.encode())
+                transport.close()
+                return
+        self.ip = ip
+        self.admitted = True
+
+        server.new_connection(transport, self.state)
+        self.state = None
 
     def data_received(self, data):
         lines = [l for l in data.decode().split('\r\n') if len(l) > 0]
@@ -29,33 +101,313 @@ class IRCClientProtocol(asyncio.Protocol):
             server.data_received(self.transport, line)
 
     def connection_lost(self, exc):
+        if not self.admitted:
+            return
+        server.limiter.release(self.ip)
         server.connection_lost(self.transport, exc)
 
-async def timer_tick(future):
+async def timer_tick(future, snapshot_path=None):
     while True:
         if future.cancelled():
             return
         await asyncio.sleep(TIMER_INTERVAL)
         server.send_pings(TIMER_INTERVAL)
+        server.limiter.expire()
+        # Save periodically so a crash only loses the last interval
+        if snapshot_path:
+            snapshot.save(server, snapshot_path)
 
-def run_server(host='0.0.0.0', port=6667):
+def _recv_exactly(sock, size):
     """
-    The main loop for the server.
+    Reads exactly `size` bytes from a blocking socket.
     """
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Handoff connection closed early')
+        data += chunk
+    return data
 
-    loop = asyncio.get_event_loop()
-    c = loop.create_server(IRCClientProtocol, host, port)
-    future = asyncio.Future()
-    asyncio.ensure_future(timer_tick(future))
+def send_handoff(conn, listeners):
+    """
+    Sends a snapshot of the server followed by the listening and client
+    sockets to a new process over the Unix socket `conn`. The listeners
+    must be stopped and the clients paused and drained beforehand.
+    """
+    transports = list(server.clients)
+    state = snapshot.dump_server(server, [server.clients[t] for t in transports])
+    state['listeners'] = len(listeners)
+    data = snapshot.encode(state)
+    conn.sendall(struct.pack('!I', len(data)) + data)
+
+    fds = [s.fileno() for s in listeners]
+    fds += [t.get_extra_info('socket').fileno() for t in transports]
+    for i in range(0, len(fds), HANDOFF_MAX_FDS):
+        batch = fds[i:i + HANDOFF_MAX_FDS]
+        socket.send_fds(conn, [struct.pack('!I', len(batch))], batch)
+
+    # Wait for the new process to confirm it has everything
+    if _recv_exactly(conn, 1) != b'\x01':
+        raise ConnectionError('Handoff was not acknowledged')
+
+def receive_handoff(path):
+    """
+    Connects to a running server's handoff socket and takes over its
+    state. Returns the snapshot and the list of received file descriptors,
+    listeners first and then clients in snapshot order.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(HANDOFF_TIMEOUT)
+        conn.connect(path)
+        size, = struct.unpack('!I', _recv_exactly(conn, 4))
+        state = snapshot.decode(_recv_exactly(conn, size))
+
+        expected = state['listeners'] + len(state['clients'])
+        fds = []
+        while len(fds) < expected:
+            msg, batch, flags, addr = socket.recv_fds(conn, 4, HANDOFF_MAX_FDS)
+            if not msg:
+                raise ConnectionError('Handoff connection closed early')
+            fds.extend(batch)
+
+        conn.sendall(b'\x01')
+
+    log.info(f'Took over {len(state["clients"])} client(s) from {path}')
+    return state, fds
+
+async def drain_clients(loop, timeout):
+    """
+    Waits until all output buffered for clients has been written.
+    """
+    deadline = loop.time() + timeout
+    while any(t.get_write_buffer_size() for t in server.clients):
+        if loop.time() >= deadline:
+            raise TimeoutError('Timed out writing buffered client output')
+        await asyncio.sleep(0.01)
+
+def accept_handoff(loop, handoff_sock, listeners, servers, result):
+    """
+    Called when a new process connects to the handoff socket. Stops
+    accepting and reading straight away, as removing the readers also
+    cancels any already selected in this iteration of the loop. The
+    handoff itself runs once the client output has been flushed.
+    """
+    conn, _ = handoff_sock.accept()
+    loop.remove_reader(handoff_sock.fileno())
+
+    # Closing the servers closes their sockets, so keep copies to send
+    listeners[:] = [s.dup() for s in listeners]
+    for net in servers:
+        net.close()
+    for t in server.clients:
+        t.pause_reading()
+
+    asyncio.ensure_future(handoff(loop, conn, handoff_sock, listeners, servers, result))
+
+async def handoff(loop, conn, handoff_sock, listeners, servers, result):
+    """
+    Hands the server over to the new process connected on `conn`. Once the
+    handoff is acknowledged this process stops serving without closing
+    any client connections. If it fails the server carries on as before.
+    """
+    with conn:
+        try:
+            await drain_clients(loop, HANDOFF_TIMEOUT)
+            conn.setblocking(True)
+            conn.settimeout(HANDOFF_TIMEOUT)
+            send_handoff(conn, listeners)
+        except OSError as e:
+            log.warning(f'Handoff failed, continuing to serve: {e}')
+            servers[:] = [await loop.create_server(IRCClientProtocol, sock=s,
+                    backlog=socket_options.backlog) for s in listeners]
+            for t in server.clients:
+                t.resume_reading()
+            loop.add_reader(handoff_sock.fileno(), accept_handoff, loop, handoff_sock,
+                    listeners, servers, result)
+            return
 
-    net = loop.run_until_complete(c)
+    for s in listeners:
+        s.close()
+    log.info(f'Handed off {len(server.clients)} client(s) to new process')
+    result['handed_off'] = True
+    loop.stop()
 
+def listen_handoff(loop, path, listeners, servers, result):
+    """
+    Opens the Unix socket that a new process connects to in order to
+    take over from this one.
+    """
+    # Replace a socket left behind by a previous run, but nothing else
     try:
-        loop.run_forever()
-    except KeyboardInterrupt:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
         pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(1)
+    sock.setblocking(False)
+    loop.add_reader(sock.fileno(), accept_handoff, loop, sock, listeners, servers, result)
+    return sock
+
+def takeover(loop, path):
+    """
+    Takes over the listening sockets and clients from a running server.
+    Returns the listening sockets.
+    """
+    state, fds = receive_handoff(path)
+    n = state['listeners']
+    listeners = [socket.socket(fileno=fd) for fd in fds[:n]]
+
+    for fd, client_state in zip(fds[n:], state['clients']):
+        sock = socket.socket(fileno=fd)
+        factory = lambda s=client_state: IRCClientProtocol(s)
+        loop.run_until_complete(loop.connect_accepted_socket(factory, sock))
+
+    snapshot.restore_channels(server, state)
+    return listeners
+
+def parse_listen(spec):
+    """
+    Parses a listen address into (family, address). Accepts `host:port`,
+    `[ipv6]:port`, a bare port, or `unix:/path`. Raises ValueError if the
+    address is not one of these.
+    """
+    if spec.startswith('unix:'):
+        if not spec[5:]:
+            raise ValueError(f'Missing socket path in {spec!r}')
+        return socket.AF_UNIX, spec[5:]
+
+    host, _, port = spec.rpartition(':')
+    family = socket.AF_INET
+    if host.startswith('[') and host.endswith(']'):
+        host = host[1:-1]
+        family = socket.AF_INET6
+    elif ':' in host:
+        raise ValueError(f'IPv6 addresses must be in brackets, e.g. [::1]:6667, not {spec!r}')
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        raise ValueError(f'Missing or invalid port in {spec!r}')
+    return family, (host or '0.0.0.0', int(port))
+
+def create_listener(spec):
+    """
+    Creates a bound, listening socket for the given listen address.
+    """
+    family, address = parse_listen(spec)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        if family == socket.AF_UNIX:
+            # Remove a stale socket left behind by a previous run
+            try:
+                if stat.S_ISSOCK(os.stat(address).st_mode):
+                    os.unlink(address)
+            except FileNotFoundError:
+                pass
+        else:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if family == socket.AF_INET6:
+                sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        socket_options.apply_listener(sock)
+        sock.bind(address)
+        sock.listen(socket_options.backlog)
+    except OSError:
+        sock.close()
+        raise
+    sock.setblocking(False)
+    log.info(f'Listening on {spec}')
+    return sock
+
+def new_event_loop(backend='auto'):
+    """
+    Creates the event loop for the given backend. `auto` uses uvloop if it
+    is installed and falls back to the stock asyncio loop otherwise.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown backend {backend!r}')
+
+    if backend != 'asyncio':
+        try:
+            import uvloop
+        except ImportError:
+            if backend == 'uvloop':
+                raise
+            uvloop = None
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            backend = 'uvloop'
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    log.info(f'Using {backend if backend != "auto" else "asyncio"} event loop')
+    return loop
+
+def run_server(listen=DEFAULT_LISTEN, backend='auto', options=None,
+        connection_classes=None, snapshot_path=None, handoff_path=None,
+        takeover_from=None):
+    """
+    The main loop for the server.
+
+    `listen` is a list of addresses as accepted by `parse_listen()`, and
+    `options` a `SocketOptions` for them. `connection_classes` replaces the
+    default connection limits if given.
+
+    If `takeover_from` is given the listening socket, clients and channels
+    are taken over from the server running there instead of starting
+    fresh. Otherwise channels are reloaded from `snapshot_path`, if given.
+    `handoff_path` is where this server waits for a new process to take
+    over from it.
+    """
+
+    global socket_options
+    if options is not None:
+        socket_options = options
+    if connection_classes:
+        server.limiter = ConnectionLimiter(connection_classes)
+
+    loop = new_event_loop(backend)
+
+    if takeover_from:
+        listeners = takeover(loop, takeover_from)
+    else:
+        if snapshot_path:
+            snapshot.load(server, snapshot_path)
+        listeners = [create_listener(spec) for spec in listen]
+    servers = [loop.run_until_complete(loop.create_server(IRCClientProtocol, sock=s,
+            backlog=socket_options.backlog)) for s in listeners]
+
+    future = asyncio.Future()
+    asyncio.ensure_future(timer_tick(future, snapshot_path))
+
+    # Stop cleanly on a service stop too, so the shutdown below always runs
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, loop.stop)
+
+    result = {'handed_off': False}
+    handoff_sock = None
+    if handoff_path:
+        handoff_sock = listen_handoff(loop, handoff_path, listeners, servers, result)
+
+    loop.run_forever()
+
+    if handoff_sock:
+        loop.remove_reader(handoff_sock.fileno())
+        handoff_sock.close()
+        # The new process has already replaced the socket file
+        if not result['handed_off']:
+            os.unlink(handoff_path)
+
+    if not result['handed_off']:
+        if snapshot_path:
+            snapshot.save(server, snapshot_path)
+        for sock in listeners:
+            if sock.family == socket.AF_UNIX:
+                os.unlink(sock.getsockname())
 
     future.cancel()
-    net.close()
-    loop.run_until_complete(net.wait_closed())
+    for net in servers:
+        net.close()
+        # Client connections now belong to the new process
+        if not result['handed_off']:
+            loop.run_until_complete(net.wait_closed())
     loop.close()
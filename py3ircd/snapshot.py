@@ -0,0 +1,145 @@
+"""
+Serialisation of server state so that a restart does not lose it.
+
+A snapshot is a plain dict (stored as compact JSON) holding the channels
+and, when handing off to a new process, the connected clients. Clients are
+identified by their position in the snapshot so that the file descriptors
+passed alongside it can be matched back up.
+"""
+
+import datetime
+import json
+import logging
+log = logging.getLogger('ircd')
+import os
+
+from channel import Channel
+
+SNAPSHOT_VERSION = 1
+
+def dump_client(client):
+    """
+    Returns the state of a single client as a dict.
+    """
+    i = client.ident
+    return {
+        'nick': i.nick,
+        'username': i.username,
+        'realname': i.realname,
+        'hostname': i.hostname,
+        'modeset': sorted(i.modeset),
+        'connected_at': client.connected_at.isoformat(),
+    }
+
+def restore_client(client, state):
+    """
+    Applies a dict from `dump_client()` to a newly created client.
+    """
+    i = client.ident
+    i.nick = state['nick']
+    i.username = state['username']
+    i.realname = state['realname']
+    i.modeset = set(state['modeset'])
+    client.connected_at = datetime.datetime.fromisoformat(state['connected_at'])
+
+def dump_channel(channel):
+    """
+    Returns the state of a single channel as a dict. Members are
+    stored by nick since only registered clients can join channels.
+    """
+    owner = channel.owner.ident.nick if channel.owner else None
+    return {
+        'name': channel.name,
+        'owner': owner,
+        'mode': channel.mode_as_str,
+        'members': sorted(c.ident.nick for c in channel.clients),
+    }
+
+def dump_server(server, clients=()):
+    """
+    Returns a snapshot of the server's channels and the given clients.
+    """
+    return {
+        'version': SNAPSHOT_VERSION,
+        'channels': [dump_channel(c) for c in server.channels.values()],
+        'clients': [dump_client(c) for c in clients],
+    }
+
+def restore_channels(server, state):
+    """
+    Recreates the channels from a snapshot. Members and owners are looked
+    up by nick from the clients already on the server; any that are not
+    (such as on a cold start) are skipped.
+    """
+    if state.get('version') != SNAPSHOT_VERSION:
+        log.warning(f'Ignoring snapshot with unknown version {state.get("version")}')
+        return
+
+    for s in state['channels']:
+        name = s['name']
+        channel = server.channels.get(name, None)
+        if not channel:
+            # Unregistered clients have no nick, so never look up None
+            owner = server.get_client_by_nick(s['owner']) if s['owner'] else None
+            channel = Channel(name, owner, s['mode'])
+            server.channels[name] = channel
+        for nick in s['members']:
+            client = server.get_client_by_nick(nick)
+            if client is None:
+                continue
+            channel.clients.add(client)
+            client.joined_channels[name] = channel
+
+def encode(state):
+    """
+    Encodes a snapshot to bytes.
+    """
+    return json.dumps(state, separators=(',', ':')).encode()
+
+def decode(data):
+    """
+    Decodes a snapshot from bytes.
+    """
+    return json.loads(data.decode())
+
+def save(server, path):
+    """
+    Writes the server's channel state to the given file. The file is
+    replaced atomically so a crash never leaves a partial snapshot.
+    Errors are logged rather than raised so a failed write never stops
+    the server.
+    """
+    tmp = f'{path}.tmp'
+    try:
+        with open(tmp, 'wb') as fp:
+            fp.write(encode(dump_server(server)))
+        os.replace(tmp, path)
+    except OSError as e:
+        log.warning(f'Could not save snapshot to {path}: {e}')
+        return
+    log.info(f'Saved {len(server.channels)} channel(s) to {path}')
+
+def check_writable(path):
+    """
+    Raises OSError if a snapshot cannot be written to the given path.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory):
+        raise FileNotFoundError(f'No such directory: {directory}')
+    if not os.access(directory, os.W_OK):
+        raise PermissionError(f'Cannot write to directory: {directory}')
+
+def load(server, path):
+    """
+    Restores channel state from the given file, if it exists.
+    """
+    try:
+        with open(path, 'rb') as fp:
+            state = decode(fp.read())
+    except FileNotFoundError:
+        return
+    except ValueError as e:
+        log.warning(f'Ignoring corrupt snapshot {path}: {e}')
+        return
+    restore_channels(server, state)
+    log.info(f'Loaded {len(server.channels)} channel(s) from {path}')
@@ -173,9 +173,14 @@ class Ident:
     # user mode set
     modeset = set()
 
-    def __init__(self, peername):
+    def __init__(self, peername, hostname=None):
         self._peername = peername
-        self.hostname = socket.gethostbyaddr(peername[0])[0]
+        if hostname is None:
+            try:
+                hostname = socket.gethostbyaddr(peername[0])[0]
+            except (socket.herror, socket.gaierror):
+                hostname = peername[0]
+        self.hostname = hostname
 
     def __str__(self):
         return f'{self.nick}!{self.username}@{self.hostname}'